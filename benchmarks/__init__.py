@@ -0,0 +1,10 @@
+"""
+Offline benchmarks for the comment bot; nothing here calls OpenRouter.
+
+    python -m benchmarks.micro       # CPU stages over the bundled comment corpus
+    python -m benchmarks.llm_stub    # local OpenAI-compatible server with configurable latency and errors
+    python -m benchmarks.loadgen     # end-to-end load against /process-comment
+    python -m benchmarks.compare     # diff two result files and flag regressions
+
+Results are written as JSON under benchmarks/results/ (see common.write_results).
+"""
@@ -0,0 +1,86 @@
+"""Helpers shared by the benchmarks: the bundled corpus, latency summaries and result files."""
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_PATH = os.path.join(BENCHMARK_DIR, "corpus.json")
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+
+def prepare_app_environment():
+    """
+    Environment for importing app.py in a benchmark: no bot warm-up thread, quiet logging and
+    a placeholder API key (the bot refuses to start without one; no request uses it).
+    Must run before `import app`.
+    """
+    os.environ.setdefault("BOT_AUTOSTART", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if not (os.getenv("OPENAI_API_KEY") or os.getenv("OPENROUTER_API_KEY")):
+        os.environ["OPENROUTER_API_KEY"] = "benchmark-placeholder"
+
+
+def load_corpus(path=CORPUS_PATH):
+    """Returns the corpus: {"posts": [{page_name, post_content}], "comments": [{text, language}]}."""
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, unit="ms", scale=1000.0):
+    """Count, mean and p50/p95/p99/max of samples given in seconds, reported in `unit`."""
+    values = sorted(s * scale for s in samples)
+    count = len(values)
+    return {
+        "count": count,
+        f"mean_{unit}": round(sum(values) / count, 3) if count else 0.0,
+        f"p50_{unit}": round(percentile(values, 50), 3),
+        f"p95_{unit}": round(percentile(values, 95), 3),
+        f"p99_{unit}": round(percentile(values, 99), 3),
+        f"max_{unit}": round(values[-1], 3) if count else 0.0
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def write_results(name, results, config=None, output=None):
+    """
+    Writes a result file: the results plus enough metadata (commit, Python, machine, config)
+    to tell two runs apart. Returns the path written.
+    """
+    document = {
+        "benchmark": name,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config or {},
+        "results": results
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    return output
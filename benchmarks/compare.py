@@ -0,0 +1,75 @@
+"""
+Compares two benchmark result files and flags regressions.
+
+    python -m benchmarks.compare OLD.json NEW.json [--threshold 10]
+
+Latency figures (*_ms, *_us) regress when they grow by more than --threshold percent;
+throughput (*_rps) regresses when it drops by more than that. Exits with status 1 if
+anything regressed, so it can gate CI.
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(results, prefix=""):
+    """{"contains_slang": {"p50_us": 3.1}} -> {"contains_slang.p50_us": 3.1}, numbers only."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def direction(metric):
+    """+1 if bigger is worse, -1 if smaller is worse, 0 if the metric is informational."""
+    leaf = metric.rsplit(".", 1)[-1]
+    if leaf.endswith(("_ms", "_us")):
+        return 1
+    if leaf.endswith("_rps"):
+        return -1
+    return 0
+
+
+def compare(old, new, threshold):
+    """Returns (rows, regressions); each row is (metric, old, new, change %, regressed)."""
+    old_flat, new_flat = flatten(old["results"]), flatten(new["results"])
+    rows = []
+    regressions = 0
+    for metric in sorted(set(old_flat) & set(new_flat)):
+        before, after = old_flat[metric], new_flat[metric]
+        change = (after - before) / before * 100.0 if before else 0.0
+        regressed = direction(metric) != 0 and change * direction(metric) > threshold
+        regressions += regressed
+        rows.append((metric, before, after, change, regressed))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent (default 10)")
+    args = parser.parse_args(argv)
+
+    with open(args.old, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    if old.get("benchmark") != new.get("benchmark"):
+        parser.error(f"cannot compare a {old.get('benchmark')} result with a {new.get('benchmark')} result")
+
+    rows, regressions = compare(old, new, args.threshold)
+    print(f"{old.get('git_commit')} -> {new.get('git_commit')} ({new.get('benchmark')})")
+    for metric, before, after, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{metric:45s} {before:>12} -> {after:>12}  {change:+7.1f}%{flag}")
+    print(f"{regressions} regression(s) beyond {args.threshold}%")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+Local OpenAI-compatible chat-completions server for benchmarks and offline testing.
+
+    python -m benchmarks.llm_stub --port 8089 --latency-ms 400 --jitter-ms 150 --error-rate 0.02
+
+Point the bot at it with LLM_BASE_URL=http://127.0.0.1:8089/v1/chat/completions.
+Each request waits latency ± jitter and then returns a canned reply with a "usage" block.
+It fails at the configured rates instead: --error-rate answers 500, --rate-limit-rate answers
+429 with Retry-After, and --timeout-rate stalls for --timeout-ms. "stream": true requests get
+server-sent events, one word per chunk, --token-ms apart. JSON-mode requests whose last message
+lists {"comments": [...]} (the bot's LLM_BATCH mode) get the canned reply once per comment_id.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "ধন্যবাদ আপনার মন্তব্যের জন্য! বিস্তারিত জানতে ইনবক্সে যোগাযোগ করুন। 😊"
+
+
+class StubConfig:
+    """Latency and failure settings, shared by all request threads."""
+
+    def __init__(self, latency_ms=300.0, jitter_ms=100.0, error_rate=0.0, rate_limit_rate=0.0,
+                 timeout_rate=0.0, timeout_ms=30000.0, token_ms=20.0, retry_after=1, reply=DEFAULT_REPLY, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_ms = timeout_ms
+        self.token_ms = token_ms
+        self.retry_after = retry_after
+        self.reply = reply
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "timeouts": 0}
+
+    def draw(self):
+        """Picks this request's fate and latency: ("ok" | "error" | "rate_limited" | "timeout", seconds)."""
+        with self.lock:
+            roll = self.random.random()
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+            if roll < self.timeout_rate:
+                fate, delay = "timeouts", self.timeout_ms / 1000.0
+            elif roll < self.timeout_rate + self.error_rate:
+                fate = "errors"
+            elif roll < self.timeout_rate + self.error_rate + self.rate_limit_rate:
+                fate = "rate_limited"
+            else:
+                fate = "ok"
+            self.counts["requests"] += 1
+            self.counts[fate] += 1
+        return fate, delay
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real provider
+    config = StubConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.config.lock:
+                self.send_json(200, dict(self.config.counts))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request_body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"message": "invalid JSON"}})
+            return
+
+        fate, delay = self.config.draw()
+        time.sleep(delay)
+        if fate == "errors":
+            self.send_json(500, {"error": {"message": "stub: injected server error"}})
+            return
+        if fate == "rate_limited":
+            self.send_json(429, {"error": {"message": "stub: injected rate limit"}},
+                           headers={"Retry-After": str(self.config.retry_after)})
+            return
+
+        reply = self.config.reply
+        if (request_body.get("response_format") or {}).get("type") == "json_object":
+            reply = self.batch_reply(request_body.get("messages") or [], reply)
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request_body.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(reply.split()),
+                 "total_tokens": prompt_tokens + len(reply.split())}
+        if request_body.get("stream"):
+            self.stream_reply(reply, usage)
+        else:
+            self.send_json(200, {
+                "id": "stub-completion",
+                "object": "chat.completion",
+                "model": request_body.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+    @staticmethod
+    def batch_reply(messages, reply):
+        """The JSON answer to a batched request: the canned reply for each listed comment."""
+        try:
+            comments = json.loads(messages[-1]["content"])["comments"]
+        except (KeyError, TypeError, ValueError, IndexError):
+            comments = []
+        replies = [{"comment_id": comment.get("comment_id"), "reply": reply} for comment in comments]
+        return json.dumps({"replies": replies}, ensure_ascii=False)
+
+    def stream_reply(self, reply, usage):
+        """Sends the reply as chunked server-sent events, one word per chunk."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        try:
+            words = reply.split(" ")
+            for index, word in enumerate(words):
+                piece = word if index == len(words) - 1 else word + " "
+                send_event(json.dumps({"choices": [{"index": 0, "delta": {"content": piece}}]}, ensure_ascii=False))
+                time.sleep(self.config.token_ms / 1000.0)
+            send_event(json.dumps({"choices": [], "usage": usage}))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client stopped reading early (see the bot's streaming cut-off)
+
+
+def make_server(host="127.0.0.1", port=0, config=None):
+    """Creates (but does not start) a stub server; port 0 picks a free port."""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"config": config or StubConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_thread(config=None, host="127.0.0.1", port=0):
+    """Starts a stub server on a background thread. Returns (server, chat completions URL)."""
+    server = make_server(host, port, config)
+    threading.Thread(target=server.serve_forever, name="llm-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1/chat/completions"
+
+
+def add_stub_arguments(parser, prefix=""):
+    """Adds the stub's latency and failure options to an argument parser."""
+    parser.add_argument(f"--{prefix}latency-ms", type=float, default=300.0, help="mean response latency")
+    parser.add_argument(f"--{prefix}jitter-ms", type=float, default=100.0, help="uniform ± latency jitter")
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=0.0, help="share of requests answered 500")
+    parser.add_argument(f"--{prefix}rate-limit-rate", type=float, default=0.0, help="share answered 429")
+    parser.add_argument(f"--{prefix}timeout-rate", type=float, default=0.0, help="share that stall for timeout-ms")
+    parser.add_argument(f"--{prefix}timeout-ms", type=float, default=30000.0, help="stall length")
+    parser.add_argument(f"--{prefix}token-ms", type=float, default=20.0, help="gap between streamed chunks")
+    parser.add_argument(f"--{prefix}seed", type=int, default=None, help="random seed for reproducible runs")
+
+
+def config_from_args(args, prefix=""):
+    prefix = prefix.replace("-", "_")
+    value = lambda name: getattr(args, prefix + name)
+    return StubConfig(latency_ms=value("latency_ms"), jitter_ms=value("jitter_ms"), error_rate=value("error_rate"),
+                      rate_limit_rate=value("rate_limit_rate"), timeout_rate=value("timeout_rate"),
+                      timeout_ms=value("timeout_ms"), token_ms=value("token_ms"), seed=value("seed"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, config_from_args(args))
+    print(f"LLM stub listening on http://{args.host}:{server.server_address[1]}/v1/chat/completions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+End-to-end load generator for /process-comment.
+
+Against a running service (which should itself point at the stub via LLM_BASE_URL):
+
+    python -m benchmarks.loadgen --url http://127.0.0.1:5000/process-comment --concurrency 16 --duration 30
+
+Self-hosted, with the LLM stub and the app started inside this process:
+
+    python -m benchmarks.loadgen --self-hosted --stub-latency-ms 400 --stub-error-rate 0.02
+
+Each of --concurrency workers sends comments drawn from the bundled corpus back to back
+(a closed loop) until --duration seconds or --requests requests. The report gives req/s and
+p50/p95/p99 latency overall and per reply outcome. Self-hosted numbers include the load
+generator's own CPU use in the same process, so use them to compare commits, not as capacity.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import requests
+
+from benchmarks.common import load_corpus, prepare_app_environment, summarize, write_results
+from benchmarks.llm_stub import add_stub_arguments, config_from_args, start_in_thread
+
+
+def build_payload(corpus, rng, distinct_posts=False):
+    """A /process-comment payload for a random corpus comment on a random corpus post."""
+    post_index = rng.randrange(len(corpus["posts"]))
+    post = corpus["posts"][post_index]
+    comment = rng.choice(corpus["comments"])
+    comment_id = uuid.uuid4().hex
+    return {
+        "data": {
+            "page_info": {"page_id": "benchmark-page", "page_name": post["page_name"]},
+            "post_info": {
+                # A fresh post_id per request defeats the reply cache, to measure the LLM path
+                "post_id": comment_id if distinct_posts else f"benchmark-post-{post_index}",
+                "post_content": post["post_content"]
+            },
+            "comment_info": {
+                "comment_id": comment_id,
+                "comment_text": comment["text"],
+                "commenter_name": rng.choice(["Rafi", "Nusrat", "Tanvir", "Sadia", "Arif"])
+            }
+        }
+    }
+
+
+def classify(response):
+    """Outcome label for a response: the reply source, or why it failed."""
+    if response.status_code != 200:
+        return f"http_{response.status_code}"
+    body = response.json()
+    if body.get("slang_detected"):
+        return "slang"
+    if body.get("from_cache"):
+        return "cached"
+    if body.get("controlled"):
+        return "fallback"
+    return "replied"
+
+
+def worker(url, corpus, args, seed, stop_at, budget, records, lock):
+    rng = random.Random(seed)
+    session = requests.Session()
+    headers = {}
+    if args.deadline_ms:
+        headers["X-Request-Deadline-Ms"] = str(args.deadline_ms)
+    while time.monotonic() < stop_at:
+        with lock:
+            if budget[0] <= 0:
+                return
+            budget[0] -= 1
+        payload = build_payload(corpus, rng, args.distinct_posts)
+        started = time.perf_counter()
+        try:
+            response = session.post(url, json=payload, headers=headers, timeout=args.timeout)
+            outcome = classify(response)
+        except requests.RequestException as e:
+            outcome = f"error_{type(e).__name__}"
+        elapsed = time.perf_counter() - started
+        with lock:
+            records.append((outcome, elapsed))
+
+
+def start_self_hosted(args):
+    """Starts the LLM stub and the app (threaded WSGI server) in this process. Returns the app URL."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass  # One access-log line per request would skew the numbers
+
+    _, stub_url = start_in_thread(config_from_args(args, prefix="stub-"))
+    os.environ["LLM_BASE_URL"] = stub_url
+    prepare_app_environment()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    app.get_bot()  # Build it before the clock starts
+    server = make_server("127.0.0.1", 0, app.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, name="app-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/process-comment"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000/process-comment")
+    parser.add_argument("--self-hosted", action="store_true", help="start the LLM stub and the app in-process")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run (default 30)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0 = no limit)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="client timeout per request, in seconds")
+    parser.add_argument("--deadline-ms", type=int, default=0, help="send X-Request-Deadline-Ms with each request")
+    parser.add_argument("--distinct-posts", action="store_true", help="a new post_id per request (no cache hits)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="result file (default benchmarks/results/load-<time>.json)")
+    add_stub_arguments(parser, prefix="stub-")
+    args = parser.parse_args(argv)
+
+    url = start_self_hosted(args) if args.self_hosted else args.url
+    corpus = load_corpus()
+    records = []
+    lock = threading.Lock()
+    budget = [args.requests if args.requests > 0 else float("inf")]
+
+    started = time.monotonic()
+    stop_at = started + args.duration
+    threads = [threading.Thread(target=worker, args=(url, corpus, args, args.seed + i, stop_at, budget, records, lock),
+                                name=f"load-{i}") for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    outcomes = Counter(outcome for outcome, _ in records)
+    by_outcome = defaultdict(list)
+    for outcome, latency in records:
+        by_outcome[outcome].append(latency)
+    failed = sum(count for outcome, count in outcomes.items() if outcome.startswith(("http_", "error_")))
+    overall = summarize([latency for _, latency in records])
+    results = {
+        "requests": len(records),
+        "failed": failed,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(records) / elapsed, 2) if elapsed else 0.0,
+        **{key: value for key, value in overall.items() if key != "count"},
+        "outcomes": dict(outcomes),
+        "by_outcome": {outcome: summarize(latencies) for outcome, latencies in sorted(by_outcome.items())}
+    }
+
+    print(f"{results['requests']} requests in {elapsed:.1f}s: {results['throughput_rps']} req/s, {failed} failed")
+    print(f"latency p50={overall['p50_ms']}ms  p95={overall['p95_ms']}ms  p99={overall['p99_ms']}ms  "
+          f"max={overall['max_ms']}ms")
+    for outcome, summary in results["by_outcome"].items():
+        print(f"  {outcome:16s} n={summary['count']:6d}  p50={summary['p50_ms']}ms  p99={summary['p99_ms']}ms")
+
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    config["url"] = url
+    path = write_results("load", results, config=config, output=args.output)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Microbenchmarks for the CPU stages of a reply, run over the bundled comment corpus.
+
+    python -m benchmarks.micro [--repeat 20] [--output PATH]
+
+Every stage is called once per corpus entry per round, and each call is timed on its own.
+The result file holds calls, mean and p50/p95/p99/max per stage in microseconds.
+count_tokens needs the tiktoken encoding, which tiktoken downloads on first use.
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+
+from benchmarks.common import load_corpus, prepare_app_environment, summarize, write_results
+
+
+def stage_inputs(bot, corpus):
+    """(stage name, function, inputs) for every benchmarked stage."""
+    texts = [comment["text"] for comment in corpus["comments"]]
+    posts = [post["post_content"] for post in corpus["posts"]]
+    post_pairs = [({"page_id": "benchmark-page", "page_name": post["page_name"]},
+                   {"post_id": f"benchmark-post-{index}", "post_content": post["post_content"]})
+                  for index, post in enumerate(corpus["posts"])]
+    return [
+        ("analyze_comment", bot.analyze_comment, texts),
+        ("clean_text_for_slang", bot.clean_text_for_slang, texts),
+        ("contains_slang", bot.contains_slang, texts),
+        ("detect_comment_language", bot.detect_comment_language, texts),
+        ("get_sentiment", bot.get_sentiment, texts),
+        ("get_sentiments", bot.get_sentiments, [texts]),  # One call scores the whole corpus
+        ("extract_contact_info", bot.extract_contact_info, posts),
+        ("post_features", lambda pair: bot.post_features(*pair), post_pairs),  # Cached after the warm-up
+        ("count_tokens", bot.count_tokens, texts + posts)
+    ]
+
+
+def run_stage(function, inputs, repeat, warmup=2):
+    """Times function(x) for each input, `repeat` rounds after `warmup` untimed ones."""
+    for _ in range(warmup):
+        for value in inputs:
+            function(value)
+    samples = []
+    clock = time.perf_counter
+    for _ in range(repeat):
+        for value in inputs:
+            started = clock()
+            function(value)
+            samples.append(clock() - started)
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20, help="timed rounds over the corpus (default 20)")
+    parser.add_argument("--only", action="append", help="run only this stage (may be repeated)")
+    parser.add_argument("--output", help="result file (default benchmarks/results/micro-<time>.json)")
+    args = parser.parse_args(argv)
+
+    prepare_app_environment()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    bot = app.get_bot()
+    corpus = load_corpus()
+    results = {}
+    for name, function, inputs in stage_inputs(bot, corpus):
+        if args.only and name not in args.only:
+            continue
+        gc.collect()
+        summary = summarize(run_stage(function, inputs, args.repeat), unit="us", scale=1e6)
+        results[name] = summary
+        print(f"{name:26s} calls={summary['count']:6d}  mean={summary['mean_us']:9.1f}us  "
+              f"p50={summary['p50_us']:9.1f}us  p95={summary['p95_us']:9.1f}us  p99={summary['p99_us']:9.1f}us")
+
+    config = {"repeat": args.repeat, "comments": len(corpus["comments"]), "posts": len(corpus["posts"])}
+    path = write_results("micro", results, config=config, output=args.output)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Shared fixtures. The tests run offline: upstream calls go to local stand-in servers, and the
+bot is built with a whitespace tokenizer instead of the tiktoken encoding (a download).
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+os.environ.setdefault("BOT_AUTOSTART", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """Answers each POST with the next (status, headers, delay) of the server's script, then 200s."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            status, headers, delay = server.script.pop(0) if server.script else (200, {}, 0.0)
+        time.sleep(delay)
+        body = json.dumps({"choices": [{"message": {"content": "ok"}}]}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def scripted_server():
+    """A local HTTP server; set .script to a list of (status, headers, delay) responses."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+    server.daemon_threads = True
+    server.script = []
+    server.calls = 0
+    server.lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class WordTokenizer:
+    """One token per whitespace-separated word; enough for budget and truncation tests."""
+
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture
+def make_bot(monkeypatch):
+    """Builds a FacebookBot offline; upstream calls go to llm_url (nothing listens by default)."""
+    import app
+
+    def make(llm_url="http://127.0.0.1:9/v1/chat/completions", **env):
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        monkeypatch.setenv("LLM_BASE_URL", llm_url)
+        monkeypatch.delenv("LLM_PROVIDERS", raising=False)
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        return app.FacebookBot(tokenizer=WordTokenizer())
+
+    return make
+
+
+@pytest.fixture
+def llm_stub():
+    """A benchmarks/llm_stub.py server answering at once; returns (StubConfig, chat completions URL)."""
+    from benchmarks.llm_stub import StubConfig, start_in_thread
+
+    server, url = start_in_thread(StubConfig(latency_ms=0.0, jitter_ms=0.0, token_ms=0.0, seed=1))
+    yield server.RequestHandlerClass.config, url
+    server.shutdown()
+    server.server_close()
+
+
+def comment_payload(comment_id, comment_text="What sizes do you have for this model?", page_id="page1", **comment):
+    """A /process-comment payload for one comment on post1."""
+    return {"data": {
+        "page_info": {"page_id": page_id, "page_name": "Shoe Shop"},
+        "post_info": {"post_id": "post1", "post_content": "New running shoes, 2500 taka."},
+        "comment_info": dict({"comment_id": comment_id, "comment_text": comment_text, "commenter_name": "Rahim"},
+                             **comment)
+    }}
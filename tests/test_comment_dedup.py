@@ -0,0 +1,58 @@
+"""CommentIdDedup soak: hours of webhook traffic on a fake clock stay within the window and the cap."""
+import app
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_memory_stays_bounded_over_a_long_run():
+    clock = FakeClock()
+    dedup = app.CommentIdDedup(window_seconds=60.0, max_entries=100000, clock=clock)
+    rate = 100  # comments per simulated second
+    peak_entries = 0
+    memory_after_first_window = None
+    for second in range(1800):
+        clock.now = float(second)
+        for i in range(rate):
+            comment_id = f"{second}_{i}"
+            assert dedup.add(comment_id)
+            if i % 10 == 0:
+                assert not dedup.add(comment_id)  # A redelivery within the window
+        peak_entries = max(peak_entries, len(dedup))
+        if second == 120:
+            memory_after_first_window = dedup.memory_bytes()
+
+    stats = dedup.stats()
+    assert peak_entries <= 61 * rate
+    assert stats["evictions"] == 0
+    assert stats["duplicates"] == 1800 * rate // 10
+    assert stats["expirations"] == 1800 * rate - len(dedup)
+    # 15x more ids have passed through since, but memory has not grown with them
+    assert dedup.memory_bytes() <= memory_after_first_window * 1.1
+
+
+def test_cap_evicts_oldest_ids_first():
+    clock = FakeClock()
+    dedup = app.CommentIdDedup(window_seconds=3600.0, max_entries=1000, clock=clock)
+    for i in range(5000):
+        clock.now = i / 10.0
+        dedup.add(str(i))
+    assert len(dedup) == 1000
+    assert dedup.stats()["evictions"] == 4000
+    assert "3999" not in dedup
+    assert "4000" in dedup
+
+
+def test_id_is_new_again_after_the_window():
+    clock = FakeClock()
+    dedup = app.CommentIdDedup(window_seconds=60.0, max_entries=10, clock=clock)
+    assert dedup.add("c1")
+    clock.now = 59.0
+    assert not dedup.add("c1")
+    clock.now = 61.0
+    assert dedup.add("c1")
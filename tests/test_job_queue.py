@@ -0,0 +1,47 @@
+"""JobQueue: attempt cap on expired leases and the callback host allow-list."""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setenv("JOB_LEASE_SECONDS", "-1")  # every running job counts as crashed
+    monkeypatch.setenv("JOB_MAX_ATTEMPTS", "2")
+    monkeypatch.setenv("JOB_CALLBACK_ALLOWED_HOSTS", "hooks.example.com, Partner.example.org")
+    return app.JobQueue(db_path=str(tmp_path / "jobs.db"), workers=0)
+
+
+def test_expired_job_is_failed_after_max_attempts(queue):
+    job_id = queue.enqueue({"comment": "hi"})
+    assert queue.claim()["job_id"] == job_id
+    assert queue.claim()["job_id"] == job_id
+    assert queue.claim() is None
+    job = queue.get(job_id)
+    assert job["status"] == "failed"
+    assert job["attempts"] == 2
+    assert "2 attempts" in job["error"]
+
+
+def test_callback_allow_list(queue):
+    assert queue.callback_allowed("https://hooks.example.com/done")
+    assert queue.callback_allowed("http://partner.example.org:8080/cb")
+    assert not queue.callback_allowed("http://169.254.169.254/latest/meta-data")
+    assert not queue.callback_allowed("http://localhost/admin")
+    assert not queue.callback_allowed("file://hooks.example.com/etc/passwd")
+    assert not queue.callback_allowed("https://hooks.example.com.evil.net/")
+    assert not queue.callback_allowed(12345)
+
+
+def test_no_callbacks_without_allow_list(tmp_path, monkeypatch):
+    monkeypatch.delenv("JOB_CALLBACK_ALLOWED_HOSTS", raising=False)
+    queue = app.JobQueue(db_path=str(tmp_path / "jobs.db"), workers=0)
+    assert not queue.callback_allowed("https://hooks.example.com/done")
+
+
+def test_process_comment_rejects_disallowed_callback(queue, monkeypatch):
+    monkeypatch.setattr(app, "_job_queue", queue)
+    response = app.app.test_client().post("/process-comment?async=true", json={
+        "comment": "hi", "callback_url": "http://10.0.0.5/internal"})
+    assert response.status_code == 400
+    assert queue.counts() == {}
@@ -0,0 +1,67 @@
+"""/process-comments: one NDJSON line per payload, even when some payloads are malformed or fail."""
+import json
+
+import pytest
+
+from conftest import comment_payload
+
+import app
+
+
+@pytest.fixture
+def client(make_bot, llm_stub, monkeypatch):
+    _, url = llm_stub
+    bot = make_bot(url)
+    monkeypatch.setattr(app, "_bot", bot)
+    return app.app.test_client(), bot
+
+
+def lines(response):
+    return sorted((json.loads(line) for line in response.get_data(as_text=True).splitlines()),
+                  key=lambda line: line["index"])
+
+
+def test_mixed_batch_streams_a_line_per_payload(client):
+    client, _ = client
+    batch = [
+        comment_payload("c1"),
+        {"data": "x"},
+        "not an object",
+        {"data": {"comment_info": {"comment_text": 5}}},
+        {"data": {"comment_info": ["c2"]}},
+        comment_payload("c3", comment_text=""),
+        comment_payload("c4", comment_text="Do you deliver to Chittagong?"),
+    ]
+    response = client.post("/process-comments", json=batch)
+    assert response.status_code == 200
+    result = lines(response)
+
+    assert [line["index"] for line in result] == list(range(len(batch)))
+    assert [line.get("status_code", 200) for line in result] == [200, 400, 400, 400, 400, 400, 200]
+    assert result[0]["comment_id"] == "c1" and result[0]["reply"]
+    assert result[6]["comment_id"] == "c4" and result[6]["reply"]
+    assert result[1] == {"index": 1, "comment_id": "", "error": "'data' must be an object", "status_code": 400}
+
+
+def test_a_failing_payload_does_not_end_the_stream(client, monkeypatch):
+    client, bot = client
+    prepare_reply = bot.prepare_reply
+
+    def flaky_prepare(json_data, deadline=None):
+        if bot.payload_comment_id(json_data) == "boom":
+            raise RuntimeError("state backend unavailable")
+        return prepare_reply(json_data, deadline)
+
+    monkeypatch.setattr(bot, "prepare_reply", flaky_prepare)
+    response = client.post("/process-comments", json=[comment_payload("boom"), comment_payload("c5")])
+    result = lines(response)
+    assert result[0]["status_code"] == 500
+    assert "state backend unavailable" in result[0]["error"]
+    assert result[1]["comment_id"] == "c5" and result[1]["reply"]
+
+
+def test_single_comment_endpoint_rejects_malformed_payloads(client):
+    client, _ = client
+    response = client.post("/process-comment", json={"data": {"post_info": "x"}})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "'data.post_info' must be an object"
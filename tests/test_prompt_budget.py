@@ -0,0 +1,80 @@
+"""build_prompt budget rules and PostCondenser caching, with one token per word (WordTokenizer)."""
+import pytest
+
+import app
+from conftest import WordTokenizer
+
+POST = {"post_id": "post1",
+        "post_content": " ".join(f"Sentence {i} is about running shoes." for i in range(400)) + " Price 2500 taka."}
+PAGE = {"page_id": "page1", "page_name": "Shoe Shop"}
+CONTACTS = {"website": "shoes.example.com", "whatsapp": "01700000000"}
+
+
+def build(bot, comment="Do you have size 42?", name="Rahim"):
+    return bot.build_prompt(comment, name, "Shoe Shop", PAGE, POST, CONTACTS, "english", "Neutral", app.StageTimer())
+
+
+def prompt_tokens(bot, messages):
+    return sum(bot.token_counter.count(message["content"]) for message in messages)
+
+
+@pytest.mark.parametrize("budget", [1500, 700, 400])
+def test_prompt_stays_within_budget(make_bot, budget):
+    bot = make_bot(PROMPT_TOKEN_BUDGET=budget)
+    for comment, name in [("hi", "Al"), ("size? " * 1000, "A very long commenter name " * 10)]:
+        messages, input_tokens, _ = build(bot, comment, name)
+        assert prompt_tokens(bot, messages) <= budget
+        assert input_tokens <= budget
+
+
+def test_comment_is_cut_to_comment_max_tokens(make_bot):
+    bot = make_bot(COMMENT_MAX_TOKENS=50)
+    messages, _, _ = build(bot, "word " * 500)
+    comment_message = next(m["content"] for m in messages if "Current comment from" in m["content"])
+    assert comment_message.count("word") == 50
+
+
+def test_post_allowance_does_not_depend_on_the_comment(make_bot):
+    bot = make_bot()
+    _, _, shared_short = build(bot, "hi", "Al")
+    _, _, shared_long = build(bot, "size? " * 1000, "A very long commenter name " * 10)
+    assert shared_short[0] == shared_long[0]
+    assert "…" in shared_short[0]
+    stats = bot.post_condenser.stats()
+    assert (stats["misses"], stats["hits"], stats["entries"]) == (1, 1, 1)
+
+
+def test_post_allowance_is_floored_at_zero(make_bot):
+    bot = make_bot(PROMPT_TOKEN_BUDGET=100)
+    _, _, shared = build(bot)
+    post_context = shared[0].split("Post content:", 1)[1]
+    assert bot.token_counter.count(post_context) <= 2  # One token of the opening sentence and the gap mark
+
+
+def test_history_is_dropped_oldest_first(make_bot):
+    # A full-length comment and a small post cap keep the post allowance at its cap below
+    bot = make_bot(PROMPT_TOKEN_BUDGET=10000, POST_CONTEXT_MAX_TOKENS=50)
+    comment = "size " * 300
+    _, base_tokens, _ = build(bot, comment)
+    for i in range(1, 4):
+        bot.add_comment_history("page1", "post1", {"comment_id": f"h{i}", "commenter_name": f"h{i}",
+                                                   "comment_text": "older comment text " * 15})
+    bot.prompt_token_budget = base_tokens + 110  # Room for two of the three 47-token entries
+    messages, input_tokens, _ = build(bot, comment)
+    history = next(m["content"] for m in messages if m["content"].startswith("Recent comments"))
+    assert "h1:" not in history
+    assert "h2:" in history and "h3:" in history
+    assert input_tokens <= bot.prompt_token_budget
+
+
+def test_condensed_post_is_cached_per_content_and_allowance():
+    counter = app.TokenCounter(WordTokenizer())
+    condenser = app.PostCondenser(counter)
+    text = POST["post_content"]
+    first = condenser.condense(text, 100)
+    assert condenser.condense(text, 100) is first
+    condenser.condense(text, 50)
+    assert condenser.condense("short post", 100) == "short post"  # Fits: not condensed or cached
+    assert condenser.stats() == {"entries": 2, "max_entries": 512, "hits": 1, "misses": 2}
+    assert counter.count(first) <= 100
+    assert "2500 taka" in first  # Key facts are kept
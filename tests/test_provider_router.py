@@ -0,0 +1,87 @@
+"""ProviderRouter failover and spill-over across local benchmarks/llm_stub.py backends."""
+import threading
+
+import pytest
+
+import app
+from benchmarks.llm_stub import StubConfig, start_in_thread
+
+
+@pytest.fixture
+def stubs():
+    servers = []
+
+    def start(**config):
+        server, url = start_in_thread(StubConfig(jitter_ms=0.0, seed=1, **config))
+        servers.append(server)
+        return server.RequestHandlerClass.config, url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_MAX_RETRIES", "0")
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "100")
+    monkeypatch.setenv("PROVIDER_EXPLORE_RATE", "0")
+    return app.LLMUpstream(app.UpstreamClient())
+
+
+def chat(router, **kwargs):
+    return router.post({"messages": [{"role": "user", "content": "hi"}]}, **kwargs)
+
+
+def test_failover_to_the_next_provider_on_5xx(stubs, upstream):
+    broken_config, broken_url = stubs(latency_ms=0.0, error_rate=1.0)
+    healthy_config, healthy_url = stubs(latency_ms=50.0)
+    router = app.ProviderRouter([app.LLMProvider("broken", broken_url, "m1"),
+                                 app.LLMProvider("healthy", healthy_url, "m2")], upstream)
+    router.providers[0].ewma_latency = 0.01  # Ranked first until it fails
+
+    provider, response = chat(router)
+    assert provider.name == "healthy"
+    assert response.status_code == 200
+    assert broken_config.counts["errors"] == 1
+    assert healthy_config.counts["ok"] == 1
+    assert router.stats()["failovers"] == 1
+
+
+def test_failed_response_is_returned_when_a_later_provider_is_skipped(stubs, upstream):
+    _, broken_url = stubs(latency_ms=0.0, error_rate=1.0)
+    open_config, open_url = stubs(latency_ms=0.0)
+    router = app.ProviderRouter([app.LLMProvider("broken", broken_url, "m1"),
+                                 app.LLMProvider("open", open_url, "m2")], upstream)
+    breaker = upstream.breaker_for(open_url)
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()  # Open: tried last, and raises CircuitOpenError without a request
+
+    provider, response = chat(router)
+    assert provider.name == "broken"
+    assert response.status_code == 500
+    assert open_config.counts["requests"] == 0
+    assert router.stats()["failovers"] == 1
+
+
+def test_spillover_when_the_fastest_provider_is_saturated(stubs, upstream):
+    fast_config, fast_url = stubs(latency_ms=300.0)
+    spare_config, spare_url = stubs(latency_ms=300.0)
+    router = app.ProviderRouter([app.LLMProvider("fast", fast_url, "m1", max_inflight=2),
+                                 app.LLMProvider("spare", spare_url, "m2", max_inflight=8)], upstream)
+    router.providers[0].ewma_latency = 0.1
+    router.providers[1].ewma_latency = 1.0
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(chat(router)[1].status_code)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [200] * 6
+    assert fast_config.counts["requests"] >= 2
+    assert spare_config.counts["requests"] >= 1
+    assert fast_config.counts["requests"] + spare_config.counts["requests"] == 6
+    assert router.stats()["spillovers"] == spare_config.counts["requests"]
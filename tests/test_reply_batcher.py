@@ -0,0 +1,51 @@
+"""ReplyBatcher keys and ids: batches never mix post contexts, and int and str ids are one comment."""
+import threading
+
+import app
+
+
+def prepared(comment_id, company="Acme", shared_context=("post about shoes",), post_id="post1"):
+    return app.PreparedReply(0.0, {"page_id": "page1"}, {"post_id": post_id},
+                             {"comment_id": comment_id, "commenter_name": "Rahim"},
+                             app.CommentAnalysis("price?"), "Neutral", "english", company, [], 0,
+                             shared_context=list(shared_context))
+
+
+def test_batch_key_covers_the_shared_prompt():
+    key = prepared("1").batch_key()
+    assert prepared("2").batch_key() == key
+    assert prepared("2", company="Other").batch_key() != key
+    assert prepared("2", shared_context=("post about bags",)).batch_key() != key
+    assert prepared("2", post_id="post2").batch_key() != key
+
+
+def test_int_and_str_ids_of_one_comment_are_deduplicated():
+    sent = []
+
+    def send(items):
+        sent.append(list(items))
+        return [item for item in items]
+
+    batcher = app.ReplyBatcher(send, window_ms=300, max_size=8)
+    results = {}
+
+    def submit(name, comment_id):
+        item = prepared(comment_id)
+        results[name] = batcher.submit(item.batch_key(), str(item.comment_id), name)
+
+    threads = [threading.Thread(target=submit, args=("first", 42))]
+    threads[0].start()
+    threads.append(threading.Thread(target=submit, args=("copy", "42")))
+    threads.append(threading.Thread(target=submit, args=("other", 43)))
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {"first": "first", "copy": "copy", "other": "other"}
+    assert sorted(len(batch) for batch in sent) == [1, 2]  # The copy is sent on its own
+
+
+def test_batch_replies_are_looked_up_by_str_id():
+    replies = app.FacebookBot.parse_batch_replies('{"replies": [{"comment_id": 42, "reply": "Hi!"}]}')
+    assert replies.get(str(prepared(42).comment_id)) == "Hi!"
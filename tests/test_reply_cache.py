@@ -0,0 +1,37 @@
+"""ReplyCache personalisation: only a salutation becomes the name placeholder."""
+import app
+
+KEY = ("page", "post", "english", "price")
+
+
+def make_cache():
+    return app.ReplyCache(max_bytes=1024 * 1024, ttl_seconds=60)
+
+
+def test_salutation_is_personalised_for_the_next_commenter():
+    cache = make_cache()
+    cache.put(KEY, "Hi Rafi! The price is 500 taka.", "Rafi")
+    assert cache.get(KEY, "Nusrat") == "Hi Nusrat! The price is 500 taka."
+
+
+def test_name_that_is_an_ordinary_word_is_not_spliced_into_the_reply():
+    cache = make_cache()
+    cache.put(KEY, "Hi Price! Price details are in the post.", "Price")
+    assert cache.get(KEY, "Nusrat") is None  # The second "Price" is a word, not the name
+    cache.put(KEY, "Please check the post for details, a link is there.", "A")
+    assert cache.get(KEY, "Nusrat") is None
+    assert cache.stats()["skipped_name_mentions"] == 2
+
+
+def test_reply_without_the_name_is_cached_as_is():
+    cache = make_cache()
+    cache.put(KEY, "Please inbox us for the price.", "Ali")
+    assert cache.get(KEY, "Nusrat") == "Please inbox us for the price."
+
+
+def test_default_name_is_never_templatized():
+    cache = make_cache()
+    cache.put(KEY, "Dear user, please check the user guide.", "User")
+    assert cache.get(KEY, "Nusrat") is None
+    cache.put(KEY, "Thanks for asking!", "User")
+    assert cache.get(KEY, "Nusrat") == "Thanks for asking!"
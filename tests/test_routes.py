@@ -0,0 +1,35 @@
+"""Request validation that happens before the bot is needed."""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize("body", [
+    {"texts": ["hello", 5]},
+    {"texts": ["hello", None]},
+    {"texts": [["nested"]]},
+    {"text": 42},
+    {"text": {"a": 1}},
+])
+def test_test_language_rejects_non_string_texts(client, body):
+    response = client.post("/test-language", json=body)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_test_language_requires_text(client):
+    assert client.post("/test-language", json={}).status_code == 400
+
+
+def test_polling_a_job_does_not_create_the_queue(client, tmp_path, monkeypatch):
+    db_path = tmp_path / "jobs.db"
+    monkeypatch.setenv("JOB_QUEUE_DB", str(db_path))
+    monkeypatch.setattr(app, "_job_queue", None)
+    assert client.get("/jobs/unknown").status_code == 404
+    assert not db_path.exists()
+    assert app._job_queue is None
@@ -0,0 +1,58 @@
+"""RuleResponder template validation: broken file templates fail at load, broken payload ones are skipped."""
+import json
+import logging
+
+import pytest
+
+import app
+
+
+def reply(responder, comment, page_info):
+    return responder.reply(app.CommentAnalysis(comment), "Positive", "english", page_info,
+                           {"website": "example.com"}, "Rahim", "Acme")
+
+
+@pytest.mark.parametrize("template", ["Hi {name", "Hi {name!x}", "Hi {name:%}", "Hi {}", "Hi {customer}", 42])
+def test_invalid_file_template_is_rejected_at_load(tmp_path, template):
+    path = tmp_path / "templates.json"
+    path.write_text(json.dumps({"pages": {"p1": {"thanks": {"english": ["Thanks {name}!", template]}}}}))
+    with pytest.raises(ValueError, match=r"pages\.p1\.thanks\.english"):
+        app.RuleResponder([], templates_file=str(path))
+
+
+def test_valid_file_templates_load(tmp_path):
+    path = tmp_path / "templates.json"
+    path.write_text(json.dumps({"default": {"thanks": {"english": "Thanks {name} from {company}!"}}}))
+    responder = app.RuleResponder([], templates_file=str(path))
+    assert reply(responder, "thanks", {}) == ("thanks", "Thanks Rahim from Acme!")
+
+
+def test_invalid_payload_template_is_skipped_with_a_log_line(caplog):
+    responder = app.RuleResponder([])
+    page_info = {"reply_templates": {"thanks": {"english": ["Hi {name", "Thanks {name}, see {website}"]}}}
+    with caplog.at_level(logging.WARNING, logger=app.logger.name):
+        for _ in range(3):
+            assert reply(responder, "thanks", page_info) == ("thanks", "Thanks Rahim, see example.com")
+    warnings = [record for record in caplog.records if "invalid" in record.getMessage()]
+    assert len(warnings) == 1  # Logged once, then remembered as invalid
+
+
+def test_only_invalid_payload_templates_fall_back_to_the_llm():
+    responder = app.RuleResponder([])
+    page_info = {"reply_templates": {"thanks": {"english": ["{name!r:"]}}}
+    assert reply(responder, "thanks", page_info) is None
+
+
+@pytest.mark.parametrize("template", ["Hi {name:>999999999}", "Hi {name!r}", "Hi {name:{company}}"])
+def test_format_specs_and_conversions_are_rejected_without_formatting(template):
+    with pytest.raises(ValueError, match="format spec or conversion"):
+        app.template_fields(template)
+
+
+def test_payload_template_cache_is_bounded(monkeypatch):
+    monkeypatch.setenv("RULE_TEMPLATE_CACHE_ENTRIES", "16")
+    responder = app.RuleResponder([])
+    for i in range(100):
+        page_info = {"reply_templates": {"thanks": {"english": [f"Thanks {{name}} #{i}", f"Bad {{name #{i}"]}}}
+        assert reply(responder, "thanks", page_info) == ("thanks", f"Thanks Rahim #{i}")
+    assert responder.stats()["cached_templates"] == 16
@@ -0,0 +1,57 @@
+"""SentimentEngine: weighted lexicon, phrase precedence, negation, Bengali inflections and NFC."""
+import pytest
+
+import app
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return app.SentimentEngine()
+
+
+def label(engine, text):
+    return engine.label(engine.score(text))
+
+
+@pytest.mark.parametrize("text, expected", [
+    # Negation before or after the hit flips its sign
+    ("this is not bad", "Positive"),
+    ("not good at all", "Negative"),
+    ("isn't good", "Negative"),
+    ("ভালো না", "Negative"),
+    ("ভালো না, একদম বাজে", "Negative"),
+    ("valo na", "Negative"),
+    # Words match whole tokens only: no "hi" inside "this", no "hao" inside "khaoa"
+    ("this", "Neutral"),
+    ("khaoa hobe", "Neutral"),
+    # A phrase outweighs the words inside it
+    ("bu hao", "Negative"),
+    ("hen hao", "Positive"),
+    ("খুব ভালো", "Positive"),
+    # Bengali inflections of lexicon words
+    ("ভালোই লাগলো", "Positive"),
+    ("সমস্যাটা কবে ঠিক হবে", "Negative"),
+    # Emoji
+    ("😡😡", "Negative"),
+    ("👍", "Positive"),
+    ("", "Neutral"),
+])
+def test_labels(engine, text, expected):
+    assert label(engine, text) == expected
+
+
+def test_phrase_is_scored_once_not_with_its_words(engine):
+    assert engine.score("খুব ভালো") == 2.0
+    assert engine.score("hen hao") == 1.5
+
+
+def test_both_spellings_of_ya_with_nukta_negate(engine):
+    precomposed = "ভালো ন\u09df"  # নয় with the single code point য়
+    decomposed = "ভালো ন\u09af\u09bc"  # নয় as য + nukta
+    assert label(engine, precomposed) == label(engine, decomposed) == "Negative"
+    assert label(engine, app.CommentAnalysis(precomposed)) == "Negative"
+
+
+def test_score_many_keeps_order_and_accepts_analyses(engine):
+    comments = ["great", app.CommentAnalysis("terrible"), "great", "ok", None]
+    assert engine.score_many(comments) == ["Positive", "Negative", "Positive", "Neutral", "Neutral"]
@@ -0,0 +1,109 @@
+"""SingleFlight roles (leader, follower, recent), the follower's wait timeout and error propagation."""
+import threading
+import time
+
+import pytest
+
+from conftest import comment_payload
+
+import app
+
+
+def test_roles_leader_follower_recent():
+    flights = app.SingleFlight(recent_ttl_seconds=60)
+    role, flight = flights.begin("k")
+    assert role == "leader"
+    assert flights.begin("k") == ("follower", flight)
+    flights.finish("k", flight, result={"reply": "hi"})
+    role, result = flights.begin("k")
+    assert role == "recent"
+    assert result == {"reply": "hi", "coalesced": "recent"}
+    assert flights.stats()["leaders"] == 1
+
+
+def test_empty_key_is_never_coalesced():
+    flights = app.SingleFlight()
+    assert flights.begin("") == ("leader", None)
+    assert flights.run("", lambda: {"n": 1}) == {"n": 1}
+    assert flights.run("", lambda: {"n": 2}) == {"n": 2}
+
+
+def test_recent_result_expires():
+    flights = app.SingleFlight(recent_ttl_seconds=0.05)
+    flights.run("k", lambda: {"n": 1})
+    time.sleep(0.1)
+    assert flights.begin("k")[0] == "leader"
+
+
+def test_followers_share_the_leaders_result():
+    flights = app.SingleFlight()
+    started = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return {"reply": "shared"}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.run("k", compute)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(flights.run("k", compute))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(result.get("coalesced", "") for result in results) == ["", "inflight", "inflight", "inflight"]
+    assert all(result["reply"] == "shared" for result in results)
+
+
+def test_follower_computes_itself_after_the_wait_timeout():
+    flights = app.SingleFlight(wait_timeout=0.05)
+    role, flight = flights.begin("k")
+    started = time.monotonic()
+    assert flights.run("k", lambda: {"reply": "local"}) == {"reply": "local"}
+    assert time.monotonic() - started < 1.0
+    assert flights.stats()["wait_timeouts"] == 1
+    flights.finish("k", flight, result={"reply": "late"})
+
+
+def test_leader_error_reaches_followers_and_is_not_remembered():
+    flights = app.SingleFlight()
+    role, flight = flights.begin("k")
+    follower_role, follower_flight = flights.begin("k")
+    assert follower_role == "follower"
+
+    def compute():
+        raise RuntimeError("upstream down")
+
+    with pytest.raises(RuntimeError):
+        flights.complete("k", flight, compute)
+    with pytest.raises(RuntimeError, match="upstream down"):
+        flights.wait_or_compute(follower_flight, lambda: {"reply": "unused"})
+    assert flights.begin("k")[0] == "leader"  # Errors are not cached as recent results
+
+
+def test_same_comment_id_on_two_pages_is_not_shared(make_bot, llm_stub):
+    stub_config, url = llm_stub
+    bot = make_bot(url, RULE_FAST_PATH="0")
+    first = bot.generate_reply(comment_payload("c1", page_id="pageA"))
+    other_page = bot.generate_reply(comment_payload("c1", page_id="pageB"))
+    duplicate = bot.generate_reply(comment_payload("c1", page_id="pageA"))
+
+    assert "coalesced" not in first and "coalesced" not in other_page
+    assert duplicate["coalesced"] == "recent"
+    assert stub_config.counts["requests"] == 2
+    assert app.FacebookBot.payload_flight_key(comment_payload(7, page_id=3)) == ("3", "7")
+    assert app.FacebookBot.payload_flight_key(comment_payload("")) == ""
+
+
+def test_explicit_zero_is_not_replaced_by_the_default(monkeypatch):
+    monkeypatch.setenv("COALESCE_RECENT_TTL_SECONDS", "30")
+    flight = app.SingleFlight(recent_ttl_seconds=0, max_recent=0)
+    assert (flight.recent_ttl_seconds, flight.max_recent) == (0, 0)
+    assert app.TokenCounter(None, max_entries=0).max_entries == 0
+    assert app.CircuitBreaker(reset_timeout=0).reset_timeout == 0
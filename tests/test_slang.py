@@ -0,0 +1,43 @@
+"""contains_slang: offensive stems are caught bare and inflected, harmless words are not."""
+import pytest
+
+from conftest import WordTokenizer
+
+import app
+
+
+@pytest.fixture(scope="module")
+def bot():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        monkeypatch.delenv("LLM_PROVIDERS", raising=False)
+        yield app.FacebookBot(tokenizer=WordTokenizer())
+
+
+@pytest.mark.parametrize("comment", [
+    # Bare stems, including ones ending in a vowel sign at the end of the comment
+    "মাগি", "এই মাগি", "চোদা", "বেশ্যা", "হারামি", "খানকি",
+    # Inflected forms
+    "মাগির", "মাগিকে", "মাগিরা", "মাগিদের", "মাগিটাকে", "চোদার", "বেশ্যার", "খানির", "বাঞ্চোতের",
+    "হারামির দল", "মাগির ছেলে", "তুই একটা হারামিই",
+    # Phrases and combinations
+    "খানকির পোলা", "মাগির বাচ্চা",
+    # English and romanized
+    "fuck you", "you are a bitch", "what a b1tch", "harami", "madarchod",
+])
+def test_offensive_comments_are_flagged(bot, comment):
+    assert bot.contains_slang(comment)
+
+
+@pytest.mark.parametrize("comment", [
+    "hello", "hi there, price?", "আসসালামু আলাইকুম ভাই", "দাম কত?", "ভালো না, একদম বাজে",
+    "খানিক পরে আসবো", "চোদ্দ টাকা", "football jersey ache?", "global shipping hobe?", "nice class",
+    "পণ্যটা খুব বাজে", "",
+])
+def test_harmless_comments_are_not_flagged(bot, comment):
+    assert not bot.contains_slang(comment)
+
+
+def test_inflections_cover_classifier_case_and_emphatic():
+    forms = app.bengali_inflections("মাগি")
+    assert {"মাগি", "মাগির", "মাগিকে", "মাগিরা", "মাগিগুলোর", "মাগিটাকেই"} <= set(forms)
@@ -0,0 +1,136 @@
+"""SQLiteStateStore: page limits hold across worker processes, and history reads see unflushed writes."""
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = textwrap.dedent("""
+    import sys
+    import app
+    db_path, worker, limit = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    store = app.SQLiteStateStore(db_path=db_path)
+    counted = 0
+    for i in range(40):
+        limit_reached, _ = store.check_and_increment("page", f"{worker}_{i}", limit)
+        counted += not limit_reached
+        store.check_and_increment("page", f"{worker}_{i}", limit)  # A duplicate delivery is not counted again
+        store.add_comment_history("page_post", f"{worker}_{i}", "hello", worker)
+    store.flush()
+    print(counted)
+""")
+
+
+def test_state_store_is_abstract():
+    with pytest.raises(TypeError):
+        app.StateStore()
+
+
+def test_page_limit_holds_across_processes(tmp_path):
+    db_path = str(tmp_path / "state.db")
+    app.SQLiteStateStore(db_path=db_path)  # Create the schema before the workers race for it
+    env = dict(os.environ, PYTHONPATH=ROOT, BOT_AUTOSTART="0")
+    workers = [subprocess.Popen([sys.executable, "-c", WORKER, db_path, f"w{n}", "100"],
+                                cwd=str(tmp_path), env=env, stdout=subprocess.PIPE, text=True)
+               for n in range(4)]
+    counted = 0
+    for worker in workers:
+        out, _ = worker.communicate(timeout=60)
+        assert worker.returncode == 0
+        counted += int(out.strip())
+
+    store = app.SQLiteStateStore(db_path=db_path)
+    assert counted == 100  # 160 distinct comments offered, exactly the limit accepted
+    assert store.get_comment_count("page") == 100
+    assert len(store.get_recent_comments("page_post", 10)) == 3  # Trimmed to HISTORY_RING_SIZE
+
+
+def test_reads_merge_pending_history_without_flushing(tmp_path):
+    store = app.SQLiteStateStore(db_path=str(tmp_path / "state.db"), history_size=3,
+                                 flush_interval=3600, batch_size=100)
+    store.add_comment_history("page_post", "c1", "first", "A")
+    store.flush()
+    store.add_comment_history("page_post", "c2", "second", "B")
+    store.add_comment_history("page_post", "c3", "third", "C")
+    store.add_comment_history("other_post", "c4", "elsewhere", "D")
+
+    recent = store.get_recent_comments("page_post", 2)
+    assert [entry["comment_id"] for entry in recent] == ["c2", "c3"]
+    assert store.stats()["pending_history_writes"] == 3
+    assert store.stats()["history_batches_written"] == 1
+
+
+@pytest.mark.parametrize("make_store", [
+    lambda tmp_path: app.InMemoryStateStore(),
+    lambda tmp_path: app.SQLiteStateStore(db_path=str(tmp_path / "state.db")),
+], ids=["memory", "sqlite"])
+def test_history_ring_size_zero_turns_history_off(tmp_path, monkeypatch, make_store):
+    monkeypatch.setenv("HISTORY_RING_SIZE", "0")
+    store = make_store(tmp_path)
+    for i in range(3):
+        store.add_comment_history("page_post", f"c{i}", "hello", "A")
+    assert store.get_recent_comments("page_post", 3) == []
+    store.store_conversation_context("page_post", {"topic": "shoes"})
+    assert store.get_conversation_context("page_post") == {"topic": "shoes"}
+
+
+def test_failed_flush_keeps_history_for_retry(tmp_path, monkeypatch):
+    store = app.SQLiteStateStore(db_path=str(tmp_path / "state.db"), history_size=3,
+                                 flush_interval=3600, batch_size=100)
+    monkeypatch.setattr(store, "max_pending", 3)
+    transaction = store._transaction
+
+    def locked(work):
+        raise app.sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(store, "_transaction", locked)
+    store.add_comment_history("page_post", "c1", "first", "A")
+    store.add_comment_history("page_post", "c2", "second", "B")
+    store.flush()
+    store.add_comment_history("page_post", "c3", "third", "C")
+    store.add_comment_history("page_post", "c4", "fourth", "D")
+    store.flush()
+    assert store.stats()["pending_history_writes"] == 3
+    assert store.stats()["history_entries_dropped"] == 1  # Over max_pending: the oldest goes
+
+    monkeypatch.setattr(store, "_transaction", transaction)
+    store.flush()
+    assert store.stats()["pending_history_writes"] == 0
+    assert [entry["comment_id"] for entry in store.get_recent_comments("page_post", 3)] == ["c2", "c3", "c4"]
+
+
+def test_prune_history_forgets_idle_posts(tmp_path, monkeypatch):
+    store = app.SQLiteStateStore(db_path=str(tmp_path / "state.db"), flush_interval=3600)
+    store.add_comment_history("old_post", "c1", "hello", "A")
+    store.store_conversation_context("old_post", {"topic": "old"})
+    store.flush()
+    now = app.time.time()
+    monkeypatch.setattr(app.time, "time", lambda: now + store.retention_seconds + 1)
+    store.add_comment_history("new_post", "c2", "hello", "B")
+    store.store_conversation_context("new_post", {"topic": "new"})
+    store.flush()
+
+    store.prune_history()
+    assert store.get_recent_comments("old_post", 3) == []
+    assert store.get_conversation_context("old_post") == {}
+    assert len(store.get_recent_comments("new_post", 3)) == 1
+    assert store.get_conversation_context("new_post") == {"topic": "new"}
+    assert (store.stats()["history_rows_pruned"], store.stats()["contexts_pruned"]) == (1, 1)
+
+
+def test_context_table_without_timestamps_is_upgraded(tmp_path):
+    db_path = str(tmp_path / "state.db")
+    conn = app.sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE conversation_context (context_key TEXT PRIMARY KEY, context TEXT NOT NULL)")
+    conn.execute("INSERT INTO conversation_context VALUES ('page_post', '{\"topic\": \"shoes\"}')")
+    conn.commit()
+    conn.close()
+
+    store = app.SQLiteStateStore(db_path=db_path)
+    store.prune_history()
+    assert store.get_conversation_context("page_post") == {"topic": "shoes"}  # Kept: its window starts now
@@ -0,0 +1,131 @@
+"""Streamed replies: ReplyCutoff, read_streamed_reply and the /process-comment/stream events."""
+import json
+
+import pytest
+
+from conftest import comment_payload
+
+import app
+
+REPLY = "We have sizes 38 to 44. Please message us to order. Thank you for asking!"
+
+
+@pytest.mark.parametrize("max_sentences, max_words, fragments, expected", [
+    (2, 50, ["We have ", "sizes. Please ", "message us. Thank ", "you!"], "We have sizes. Please message us."),
+    (1, 50, ["Hi! 😊 ", "Welcome."], "Hi! 😊"),  # Trailing emoji stay with their sentence
+    (0, 3, ["one two ", "three fo", "ur five"], "one two three"),
+    (5, 3, ["one two three"], "one two three"),  # The third word may still be growing: not complete yet
+    (0, 0, ["no limits at all. Really."], "no limits at all. Really."),
+])
+def test_reply_cutoff(max_sentences, max_words, fragments, expected):
+    cutoff = app.ReplyCutoff(max_sentences, max_words)
+    kept = []
+    for fragment in fragments:
+        piece, complete = cutoff.feed(fragment)
+        kept.append(piece)
+        if complete:
+            break
+    assert cutoff.text == expected
+    assert "".join(kept).rstrip() == expected  # Whitespace already relayed before the cut may remain
+
+
+class FakeStream:
+    """A requests-style response streaming the given SSE lines."""
+
+    def __init__(self, lines, status_code=200):
+        self.lines = lines
+        self.status_code = status_code
+        self.read = 0
+        self.closed = False
+
+    def iter_lines(self, chunk_size=None):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+    def close(self):
+        self.closed = True
+
+    def raise_for_status(self):
+        pass
+
+
+def sse(*fragments, usage=None):
+    lines = [f"data: {json.dumps({'choices': [{'delta': {'content': f}}]})}".encode("utf-8") for f in fragments]
+    lines.insert(1, b": keep-alive comment")
+    if usage:
+        lines.append(f"data: {json.dumps({'choices': [], 'usage': usage})}".encode("utf-8"))
+    return lines + [b"data: [DONE]"]
+
+
+def test_read_streamed_reply_reads_to_done(make_bot):
+    bot = make_bot()
+    usage = {"prompt_tokens": 10, "completion_tokens": 3}
+    response = FakeStream(sse("Hello ", "there.", usage=usage))
+    tokens = []
+    assert bot.read_streamed_reply(response, tokens.append) == ("Hello there.", usage, False)
+    assert tokens == ["Hello ", "there."]
+    assert response.closed
+
+
+def test_read_streamed_reply_stops_at_the_cutoff(make_bot):
+    bot = make_bot(STREAM_MAX_SENTENCES=1)
+    response = FakeStream(sse("Yes. ", "We deliver. ", "More text", "and more."))
+    text, usage, cut_off = bot.read_streamed_reply(response)
+    assert (text, usage, cut_off) == ("Yes.", None, True)
+    assert response.read < len(response.lines)  # The rest of the stream was not read
+    assert response.closed
+
+
+@pytest.mark.parametrize("status_code", [401, 402, 429, 500])
+def test_error_responses_are_closed_before_the_fallback(make_bot, monkeypatch, status_code):
+    bot = make_bot(LLM_STREAM=1)
+    response = FakeStream([], status_code=status_code)
+    response.raise_for_status = lambda: (_ for _ in ()).throw(app.requests.HTTPError(str(status_code)))
+    provider = bot.providers.providers[0]
+    monkeypatch.setattr(bot.providers, "post", lambda *args, **kwargs: (provider, response))
+    result = bot.generate_reply(comment_payload("c1"))
+    assert result["tier"] == "fallback"
+    assert response.closed
+    assert response.read == 0
+
+
+def events(response):
+    """(event, data) pairs of a server-sent-events body."""
+    parsed = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if block:
+            event, data = block.split("\n")
+            parsed.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return parsed
+
+
+def test_process_comment_stream_events(make_bot, llm_stub, monkeypatch):
+    config, url = llm_stub
+    config.reply = REPLY
+    monkeypatch.setattr(app, "_bot", make_bot(url, STREAM_MAX_SENTENCES=2))
+    response = app.app.test_client().post("/process-comment/stream", json=comment_payload("c1"))
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+
+    sent = events(response)
+    names = [event for event, _ in sent]
+    assert names[-1] == "done" and set(names[:-1]) == {"token"}
+    streamed = "".join(data["text"] for _, data in sent[:-1])
+    done = sent[-1][1]
+    assert streamed.rstrip() == "We have sizes 38 to 44. Please message us to order."
+    assert done["reply"] == streamed.rstrip()
+    assert done["tier"] == "llm" and done["stream_cut_off"] is True
+    assert done["comment_id"] == "c1"
+
+
+def test_process_comment_stream_duplicate_gets_only_done(make_bot, llm_stub, monkeypatch):
+    config, url = llm_stub
+    config.reply = REPLY
+    monkeypatch.setattr(app, "_bot", make_bot(url))
+    client = app.app.test_client()
+    first = events(client.post("/process-comment/stream", json=comment_payload("c1")))
+    second = events(client.post("/process-comment/stream", json=comment_payload("c1")))
+    assert [event for event, _ in second] == ["done"]
+    assert second[0][1]["reply"] == first[-1][1]["reply"]
+    assert config.counts["requests"] == 1
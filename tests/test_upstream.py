@@ -0,0 +1,145 @@
+"""LLMUpstream retry policy and CircuitBreaker, against a local server that injects 429s and 5xx."""
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+import app
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_MAX_RETRIES", "2")
+    monkeypatch.setenv("UPSTREAM_BACKOFF_BASE_SECONDS", "0.01")
+    monkeypatch.setenv("UPSTREAM_BACKOFF_MAX_SECONDS", "3")
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "3")
+    monkeypatch.setenv("CIRCUIT_RESET_TIMEOUT_SECONDS", "0.2")
+    return app.LLMUpstream(app.UpstreamClient())
+
+
+class FakeResponse:
+    def __init__(self, retry_after):
+        self.headers = {"Retry-After": retry_after}
+
+
+def test_retry_after_in_seconds(upstream, scripted_server):
+    scripted_server.script = [(429, {"Retry-After": "0.3"}, 0.0)]
+    started = time.monotonic()
+    response = upstream.post(scripted_server.url, "key", json={})
+    assert response.status_code == 200
+    assert time.monotonic() - started >= 0.3
+    assert scripted_server.calls == 2
+    assert upstream.stats()["retry_after_honoured"] == 1
+
+
+def test_retry_after_as_http_date(upstream, scripted_server):
+    retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=2), usegmt=True)
+    assert 0.5 < upstream.retry_after_seconds(FakeResponse(retry_at)) <= 2.0
+    assert upstream.retry_after_seconds(FakeResponse("not a date")) is None
+
+    scripted_server.script = [(503, {"Retry-After": retry_at}, 0.0)]
+    started = time.monotonic()
+    assert upstream.post(scripted_server.url, "key", json={}).status_code == 200
+    assert time.monotonic() - started >= 0.5  # HTTP dates have whole-second precision
+
+
+def test_retry_after_longer_than_backoff_max_is_not_waited_for(upstream, scripted_server):
+    scripted_server.script = [(429, {"Retry-After": "60"}, 0.0)]
+    assert upstream.post(scripted_server.url, "key", json={}).status_code == 429
+    assert scripted_server.calls == 1
+
+
+def test_retries_exhausted_return_the_last_response(upstream, scripted_server):
+    scripted_server.script = [(500, {}, 0.0)] * 3 + [(200, {}, 0.0)]
+    response = upstream.post(scripted_server.url, "key", json={})
+    assert response.status_code == 500
+    assert scripted_server.calls == 3  # The first attempt and UPSTREAM_MAX_RETRIES retries
+    assert upstream.stats()["retries"] == 2
+
+
+def test_breaker_opens_then_half_open_probe_closes_it(upstream, scripted_server):
+    scripted_server.script = [(500, {}, 0.0)] * 3
+    upstream.post(scripted_server.url, "key", json={})
+    breaker = upstream.breaker_for(scripted_server.url)
+    assert breaker.state == app.CircuitBreaker.OPEN
+
+    with pytest.raises(app.CircuitOpenError):
+        upstream.post(scripted_server.url, "key", json={})
+    assert scripted_server.calls == 3  # Failed fast without calling upstream
+
+    time.sleep(0.25)
+    assert upstream.post(scripted_server.url, "key", json={}).status_code == 200
+    assert breaker.state == app.CircuitBreaker.CLOSED
+
+
+def test_unexpected_error_during_probe_does_not_wedge_the_breaker(upstream, scripted_server, monkeypatch):
+    breaker = upstream.breaker_for(scripted_server.url)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.25)
+
+    def broken_post(url, timeout=None, **kwargs):
+        raise RuntimeError("not a network error")
+
+    monkeypatch.setattr(upstream.http_client, "post", broken_post)
+    with pytest.raises(RuntimeError):
+        upstream.post(scripted_server.url, "key", json={})
+    monkeypatch.undo()
+    # The probe slot was given back, so the next call is the probe and closes the breaker
+    assert upstream.post(scripted_server.url, "key", json={}).status_code == 200
+    assert breaker.state == app.CircuitBreaker.CLOSED
+
+
+def test_non_retryable_request_error_counts_as_a_failure(upstream, scripted_server, monkeypatch):
+    breaker = upstream.breaker_for(scripted_server.url)
+    calls = []
+
+    def redirect_loop(url, timeout=None, **kwargs):
+        calls.append(url)
+        raise requests.exceptions.TooManyRedirects("redirect loop")
+
+    monkeypatch.setattr(upstream.http_client, "post", redirect_loop)
+    with pytest.raises(requests.exceptions.TooManyRedirects):
+        upstream.post(scripted_server.url, "key", json={})
+    assert len(calls) == 1
+    assert breaker.consecutive_failures == 1
+
+
+def test_zero_rate_disables_client_side_limit(monkeypatch, scripted_server):
+    monkeypatch.setenv("UPSTREAM_RATE_PER_SECOND", "0")
+    upstream = app.LLMUpstream(app.UpstreamClient())
+    assert upstream.bucket_for("key") is None
+    assert upstream.post(scripted_server.url, "key", json={}).status_code == 200
+
+
+def test_hedge_wins_over_a_slow_first_request(upstream, scripted_server):
+    upstream.hedge_enabled = True
+    upstream.hedge_default_delay = 0.05
+    scripted_server.script = [(200, {}, 0.5)]
+    started = time.monotonic()
+    assert upstream.post_hedged(scripted_server.url, "key", json={}).status_code == 200
+    assert time.monotonic() - started < 0.4
+    assert upstream.stats()["hedges_won"] == 1
+
+
+def test_first_requests_do_not_queue_behind_the_hedge_pool(upstream, scripted_server, monkeypatch):
+    monkeypatch.setenv("HEDGE_WORKERS", "1")
+    upstream.hedge_enabled = True
+    upstream.hedge_default_delay = 5.0
+    scripted_server.script = [(200, {}, 0.3)] * 4
+    started = time.monotonic()
+    with app.ThreadPoolExecutor(max_workers=4) as callers:
+        responses = list(callers.map(
+            lambda _: upstream.post_hedged(scripted_server.url, "key", json={}), range(4)))
+    assert [r.status_code for r in responses] == [200] * 4
+    assert time.monotonic() - started < 1.0  # Run one at a time they would take 1.2s
+    assert upstream.stats()["hedges_sent"] == 0
+
+
+def test_retry_budget_exhausted_reraises_the_last_error(upstream):
+    upstream.retry_budget = 0.0  # No time for a retry after the first failure
+    with pytest.raises(requests.exceptions.ConnectionError):
+        upstream.post("http://127.0.0.1:9/v1/chat/completions", "key", json={})
+    assert upstream.stats()["retries"] == 0
@@ -0,0 +1,30 @@
+"""UpstreamClient keeps connections alive: only the first request to a host opens one."""
+import app
+
+
+def test_sequential_posts_reuse_one_connection(scripted_server):
+    client = app.UpstreamClient()
+    assert client.metrics()["requests"] == 0
+    for _ in range(5):
+        response = client.post(scripted_server.url, json={})
+        assert response.status_code == 200
+    metrics = client.metrics()
+    assert metrics["hosts"] == 1
+    assert metrics["requests"] == 5
+    assert metrics["connections_opened"] == 1
+    assert metrics["connections_reused"] == 4
+    assert scripted_server.calls == 5
+
+
+def test_pool_is_bounded_by_pool_maxsize(scripted_server):
+    client = app.UpstreamClient(pool_maxsize=2)
+    scripted_server.script = [(200, {}, 0.2)] * 4
+    with app.ThreadPoolExecutor(max_workers=4) as callers:
+        list(callers.map(lambda _: client.post(scripted_server.url, json={}).close(), range(4)))
+    for _ in range(4):
+        client.post(scripted_server.url, json={})
+    metrics = client.metrics()
+    assert metrics["requests"] == 8
+    # Connections beyond pool_maxsize are discarded after use; the later requests reuse the kept ones
+    assert metrics["connections_opened"] == 4
+    assert metrics["connections_reused"] == 4